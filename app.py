@@ -1,48 +1,236 @@
+from gevent import monkey
+monkey.patch_all()
+
+import gevent
+
+import hashlib
+import mimetypes
 import os
+import shutil
+import tempfile
+import time
 from datetime import datetime, timedelta
 
-from flask import Flask, render_template, redirect, url_for, flash, request, jsonify, send_from_directory
+from flask import Flask, render_template, redirect, url_for, flash, request, jsonify, send_from_directory, session, make_response, abort
+from flask_caching import Cache
+from jinja2 import FileSystemBytecodeCache
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
+from werkzeug.security import check_password_hash, generate_password_hash
 from werkzeug.utils import secure_filename
+from sqlalchemy import insert, select
+from sqlalchemy.orm import make_transient_to_detached, selectinload
 from flask_socketio import SocketIO, join_room, leave_room, emit, send
-import bleach
+from gevent.queue import Queue, Empty
+from flask_session import Session
+from redis import Redis
+from bleach.sanitizer import Cleaner
+import orjson
+
+from utils import OrjsonCodec, OrjsonProvider, contains_profanity
 
 UPLOAD_FOLDER = 'static/uploads'
 ALLOWED_EXT = {'png','jpg','jpeg','gif','mp4','webm','mov'}
+# when set (e.g. '/protected_uploads/'), nginx streams uploads from an internal location:
+#   location /protected_uploads/ { internal; alias /app/static/uploads/; }
+UPLOADS_ACCEL_PREFIX = os.environ.get('UPLOADS_ACCEL_PREFIX')
+UPLOAD_CACHE_MAX_AGE = 365 * 24 * 3600  # seconds
+UPLOAD_CHUNK_SIZE = 256 * 1024
+REDIS_URL = os.environ.get('REDIS_URL')  # optional; caches are skipped without it
+USER_CACHE_TTL = 300  # seconds
+# every worker may open pool_size + max_overflow connections; keep
+# workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) below the server's max_connections
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 20))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 40))
+PAGE_CACHE_TTL = 30  # seconds; anonymous landing page
+# seconds; nothing in the app creates rooms, so after adding one from a shell either
+# wait this out or run cache.delete('rooms_list')
+ROOMS_CACHE_TTL = 600
+MODERATION_CACHE_TTL = 30  # seconds; bounds how long a new mute or ban goes unnoticed
+MESSAGE_BATCH_SIZE = 200
+MESSAGE_FLUSH_INTERVAL = 0.05  # seconds
+MAX_MESSAGE_LENGTH = 4000  # characters; checked before any sanitizing work
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)  # jsonify / request.json
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret')
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///rainchat.db')
+# SQLAlchemy rejects Heroku's postgres:// and maps postgresql:// to psycopg2; pin psycopg 3
+for _scheme in ('postgres://', 'postgresql://'):
+    if app.config['SQLALCHEMY_DATABASE_URI'].startswith(_scheme):
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql+psycopg://' + app.config['SQLALCHEMY_DATABASE_URI'][len(_scheme):]
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_recycle': 300,
+    'pool_pre_ping': True,
+}
+if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    # server databases only: in-memory SQLite gets a StaticPool, which rejects pool sizing
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'].update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW)
+if app.config['SQLALCHEMY_DATABASE_URI'].startswith('postgresql'):
+    # message timestamps default to CURRENT_TIMESTAMP in a naive column; keep them in UTC like the rest
+    app.config['SQLALCHEMY_ENGINE_OPTIONS']['connect_args'] = {'options': '-c timezone=utc'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+# persist compiled templates so fresh workers skip the parse/compile step; without
+# JINJA_CACHE_DIR jinja picks a private per-user directory under the system temp dir
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(os.environ.get('JINJA_CACHE_DIR'))
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB uploads
 
+redis_client = Redis.from_url(REDIS_URL) if REDIS_URL else None
+if redis_client is not None:
+    # server-side sessions: one Redis GET per request instead of decoding the cookie
+    app.config['SESSION_TYPE'] = 'redis'
+    app.config['SESSION_REDIS'] = redis_client
+    Session(app)
+
+cache = Cache(app, config=(
+    {'CACHE_TYPE': 'RedisCache', 'CACHE_REDIS_URL': REDIS_URL} if REDIS_URL else {'CACHE_TYPE': 'SimpleCache'}
+))
+
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'  # if not logged in, redirect here
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet')
+# with REDIS_URL set, room broadcasts go through Redis pub/sub so every worker delivers them
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode='gevent', message_queue=REDIS_URL, json=OrjsonCodec)
 
 from models import User, Message, Room, Reaction, PinnedMessage, Block, Ban, Mute
 from forms import RegisterForm, LoginForm, ProfileForm
 
 # --- Flask-Login user loader ---
+# users are cached in Redis as JSON of their column values (no pickle to trust); the password
+# hash stays out of the cache and is lazy-loaded in the rare case something reads it
+_USER_FIELDS = [c.key for c in User.__table__.columns if c.key != 'password_hash']
+_USER_DATETIME_FIELDS = [c.key for c in User.__table__.columns if isinstance(c.type, db.DateTime)]
+
 @login_manager.user_loader
 def load_user(user_id):
     """Tell Flask-Login how to load a user by ID."""
-    return User.query.get(int(user_id))
+    if redis_client is None:
+        return db.session.get(User, int(user_id))
+    key = f"user:{user_id}"
+    cached = redis_client.get(key)
+    if cached:
+        # entries outlive deploys: drop columns that no longer exist; columns added since are
+        # simply absent, and like password_hash get lazy-loaded if read
+        fields = {name: value for name, value in orjson.loads(cached).items() if name in _USER_FIELDS}
+        for name in _USER_DATETIME_FIELDS:
+            if fields.get(name):
+                fields[name] = datetime.fromisoformat(fields[name])
+        user = User(**fields)
+        # mark it as an unmodified persisted row, then attach it without a SELECT
+        # so edits made during the request still get flushed
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+    user = db.session.get(User, int(user_id))
+    if user:
+        redis_client.setex(key, USER_CACHE_TTL, orjson.dumps({name: getattr(user, name) for name in _USER_FIELDS}))
+    return user
+
+def forget_user(user_id):
+    """Drop a cached user after its row changed."""
+    if redis_client is not None:
+        redis_client.delete(f"user:{user_id}")
 
 # --- utility functions ---
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXT
 
+def run_in_thread(fn, *args):
+    """Run a CPU-heavy or blocking call on a native thread so other greenlets keep being served."""
+    return gevent.get_hub().threadpool.apply(fn, args)
+
+def save_upload(f):
+    """Store an upload under its content hash, so identical files are written only once."""
+    # werkzeug spools uploads to a seekable file: hash it first, then copy only if it's new
+    digest = hashlib.blake2b(digest_size=16)
+    for chunk in iter(lambda: f.stream.read(UPLOAD_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    filename = f"{digest.hexdigest()}.{f.filename.rsplit('.', 1)[1].lower()}"
+    path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    if not os.path.exists(path):
+        f.stream.seek(0)
+        # write aside and rename, so the immutable URL never serves a half-written file
+        fd, tmp_path = tempfile.mkstemp(dir=app.config['UPLOAD_FOLDER'])
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                shutil.copyfileobj(f.stream, out, UPLOAD_CHUNK_SIZE)
+            os.chmod(tmp_path, 0o644)  # mkstemp is owner-only; the web server must read it
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    return filename
+
+# room id -> (id, room_name, is_private); rooms are not edited at runtime, so entries never go stale
+ROOM_CACHE = {}
+
+def cached_room(room_id):
+    """Look up a room by id, hitting the DB once per room per process."""
+    try:
+        room_id = int(room_id)
+    except (TypeError, ValueError):
+        return None
+    info = ROOM_CACHE.get(room_id)
+    if info is None:
+        room = db.session.get(Room, room_id)
+        if not room:
+            return None
+        info = ROOM_CACHE[room_id] = (room.id, room.room_name, room.is_private)
+    return info
+
+@cache.cached(timeout=ROOMS_CACHE_TTL, key_prefix='rooms_list')
+def public_rooms():
+    """Public rooms for the chat sidebar; they change a few times a day, so serve them from cache."""
+    # plain dicts of the three columns the sidebar shows: cheap to (un)pickle, no ORM hydration
+    rows = db.session.execute(
+        select(Room.id, Room.room_name, Room.title).filter_by(is_private=False)
+    ).mappings()
+    return [dict(row) for row in rows]
+
+def _page_is_personal():
+    # base.html renders a per-login nav and pops flashed messages, so only share anonymous, flash-free renders
+    return current_user.is_authenticated or '_flashes' in session
+
+def _cached_flag(key, load):
+    """Serve a yes/no moderation answer from Redis, falling back to load() -> (flag, ttl)."""
+    if redis_client is None:
+        return load()[0]
+    cached = redis_client.get(key)
+    if cached is not None:
+        return cached == b'1'
+    flag, ttl = load()
+    redis_client.setex(key, ttl, '1' if flag else '0')
+    return flag
+
+def is_muted(user_id, room_id):
+    """Whether the user has an unexpired mute in the room."""
+    def load():
+        mute = Mute.query.filter_by(user_id=user_id, room_id=room_id).first()
+        now = datetime.utcnow()
+        if mute and mute.expires_at and mute.expires_at > now:
+            # never keep reporting a mute after it has run out
+            return True, max(1, min(MODERATION_CACHE_TTL, int((mute.expires_at - now).total_seconds())))
+        return False, MODERATION_CACHE_TTL
+    return _cached_flag(f"mute:{user_id}:{room_id}", load)
+
+def is_banned(user_id, room_id):
+    """Whether the user is banned from the room."""
+    def load():
+        return Ban.query.filter_by(user_id=user_id, room_id=room_id).first() is not None, MODERATION_CACHE_TTL
+    return _cached_flag(f"ban:{user_id}:{room_id}", load)
+
+# basic sanitize using bleach - extend for more rules. Built once: bleach.clean()
+# constructs a new Cleaner (and its html5lib parser/serializer) on every call.
+# Cleaner isn't thread-safe, but greenlets never switch inside clean(); don't call it via run_in_thread.
+_CLEANER = Cleaner(strip=True)
+
 def sanitize(text):
-    # basic sanitize using bleach - extend for more rules
-    return bleach.clean(text, strip=True)
+    return _CLEANER.clean(text)
 
 # --- routes ---
 @app.route('/')
+@cache.cached(timeout=PAGE_CACHE_TTL, unless=_page_is_personal)
 def index():
     return render_template('index.html')
 
@@ -50,17 +238,19 @@ def index():
 def register():
     form = RegisterForm()
     if form.validate_on_submit():
-        # check duplicates by email or phone
-        if User.query.filter((User.email == form.email.data) | (User.phone == form.phone.data)).first():
+        email = form.email.data.lower()
+        # check duplicates by email or phone; only existence matters, so don't hydrate a User
+        if db.session.query(User.id).filter((User.email == email) | (User.phone == form.phone.data)).first():
             flash("You have registered before. Use login or recover password.", "warning")
             return redirect(url_for('login'))
         u = User(
             name=form.name.data,
-            email=form.email.data.lower(),
+            email=email,
             nickname=form.nickname.data,
             phone=form.phone.data,
         )
-        u.set_password(form.password.data)
+        # hash on a native thread, but set the mapped attribute back here on the hub
+        u.password_hash = run_in_thread(generate_password_hash, form.password.data)
         db.session.add(u)
         db.session.commit()
         flash("Successfully registered. You can now login.", "success")
@@ -71,17 +261,20 @@ def register():
 def login():
     form = LoginForm()
     if form.validate_on_submit():
-        user = User.query.filter_by(email=form.email.data.lower()).first()
-        if not user:
+        # only the credentials are needed until the password checks out; skip hydrating a User
+        creds = db.session.execute(
+            select(User.id, User.password_hash, User.banned).where(User.email == form.email.data.lower())
+        ).first()
+        if not creds:
             flash("No account found with that email.", "danger")
             return redirect(url_for('register'))
-        if user.check_password(form.password.data):
+        # password hashing is deliberately slow; don't stall every socket on the hub meanwhile
+        if run_in_thread(check_password_hash, creds.password_hash, form.password.data):
             # check ban
-            ban = Ban.query.filter_by(user_id=user.id).first()
-            if ban:
+            if creds.banned or db.session.query(Ban.id).filter_by(user_id=creds.id).first():
                 flash("Your account is banned.", "danger")
                 return redirect(url_for('index'))
-            login_user(user)
+            login_user(db.session.get(User, creds.id))
             flash("Successfully logged in.", "success")
             return redirect(url_for('chat'))
         else:
@@ -106,24 +299,38 @@ def profile():
         # handle avatar
         f = request.files.get('avatar')
         if f and allowed_file(f.filename):
-            filename = secure_filename(f"{current_user.id}-{datetime.utcnow().timestamp()}-{f.filename}")
-            path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            f.save(path)
-            current_user.avatar = filename
+            # up to 50MB of hashing and disk writes; keep them off the hub
+            current_user.avatar = run_in_thread(save_upload, f)
         db.session.commit()
+        forget_user(current_user.id)
         flash("Profile updated.", "success")
         return redirect(url_for('profile'))
     return render_template('profile.html', form=form)
 
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    if UPLOADS_ACCEL_PREFIX:
+        # stored names are already secure_filename() output; anything else was never uploaded
+        if filename != secure_filename(filename):
+            abort(404)
+        resp = make_response('')
+        resp.headers['X-Accel-Redirect'] = UPLOADS_ACCEL_PREFIX + filename
+        # nginx keeps the upstream Content-Type, which would otherwise be Flask's text/html
+        resp.mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    else:
+        resp = send_from_directory(app.config['UPLOAD_FOLDER'], filename, max_age=UPLOAD_CACHE_MAX_AGE)
+    # only the extension is checked on upload; don't let browsers sniff an image into HTML
+    resp.headers['X-Content-Type-Options'] = 'nosniff'
+    # stored names are content hashes, so a file never changes under its URL
+    resp.cache_control.public = True
+    resp.cache_control.max_age = UPLOAD_CACHE_MAX_AGE
+    resp.cache_control.immutable = True
+    return resp
 
 @app.route('/chat')
 @login_required
 def chat():
-    rooms = Room.query.filter_by(is_private=False).all()
-    return render_template('chat.html', rooms=rooms, user=current_user)
+    return render_template('chat.html', rooms=public_rooms(), user=current_user)
 
 # search messages example
 @app.route('/search')
@@ -132,7 +339,11 @@ def search():
     q = request.args.get('q', '').strip()
     results = []
     if q:
-        results = Message.query.filter(Message.content.contains(q)).order_by(Message.timestamp.desc()).limit(100).all()
+        # authors are rendered next to each hit; fetch them all in one extra SELECT ... IN
+        results = (Message.query.options(selectinload(Message.user))
+                   .filter(Message.content.contains(q))
+                   .order_by(Message.timestamp.desc(), Message.id.desc())
+                   .limit(100).all())
     return render_template('search.html', results=results, q=q)
 
 # Admin actions: pin message, mute/ban etc (simple POST endpoints)
@@ -142,7 +353,7 @@ def pin_message():
     if not current_user.is_admin:
         return jsonify({'error': 'forbidden'}), 403
     mid = request.json.get('message_id')
-    msg = Message.query.get(mid)
+    msg = db.session.get(Message, mid)
     if not msg:
         return jsonify({'error': 'not found'}), 404
     pm = PinnedMessage(message_id=msg.id, room_id=msg.room_id, pinned_by=current_user.id)
@@ -150,78 +361,176 @@ def pin_message():
     db.session.commit()
     return jsonify({'ok': True})
 
+def _broadcast_if_subscribed(event, payload, rooms):
+    """Emit once to a room or list of rooms, skipping the encode and send when all are empty."""
+    if isinstance(rooms, str):
+        rooms = [rooms]
+    # with a message queue the listeners may be connected to another worker, so always publish
+    local_rooms = socketio.server.manager.rooms.get('/', {})
+    if REDIS_URL is None and not any(local_rooms.get(room) for room in rooms):
+        return
+    # a list target is encoded once and each subscribed sid gets it once, even if it is in several rooms
+    socketio.emit(event, payload, to=rooms)
+
+# --- batched message writer ---
+_message_queue = Queue()
+
+def _write_messages(rows):
+    """Insert rows with one Core executemany and commit; returns (id, timestamp) pairs in row order."""
+    # skips the ORM unit of work; sort_by_parameter_order keeps results lined up with the rows.
+    # the database stamps each row and it is read back; set explicitly rather than left to the
+    # column default, which tables created before that default existed don't have
+    table = Message.__table__
+    saved = db.session.execute(
+        insert(table).values(timestamp=db.func.current_timestamp())
+        .returning(table.c.id, table.c.timestamp, sort_by_parameter_order=True),
+        rows,
+    ).all()
+    db.session.commit()
+    return [tuple(r) for r in saved]
+
+def _store_messages(rows):
+    """Write a batch of message rows; returns their (id, timestamp), with None for any row that was rejected."""
+    with app.app_context():
+        try:
+            return _write_messages(rows)
+        except Exception:
+            db.session.rollback()
+            app.logger.exception("batch of %d messages failed, retrying one by one", len(rows))
+        # isolate the bad rows so one of them doesn't cost everyone else their message
+        saved = []
+        for row in rows:
+            try:
+                saved.extend(_write_messages([row]))
+            except Exception:
+                db.session.rollback()
+                saved.append(None)
+        return saved
+
+def _send_batch(batch):
+    """Write one batch of queued messages, then broadcast each with its id and timestamp."""
+    # drivers like sqlite3 block in C without yielding, so the writes run on a native thread
+    saved = run_in_thread(_store_messages, [row for row, _, _, _, _ in batch])
+    for (row, payload, event, rooms, sid), result in zip(batch, saved):
+        if result is None:
+            socketio.emit('error', {'error': 'message could not be saved'}, to=sid)
+            continue
+        # the timestamp is serialized to ISO 8601 by OrjsonCodec
+        payload['id'], payload['timestamp'] = result
+        _broadcast_if_subscribed(event, payload, rooms)
+
+def _flush_messages():
+    """Drain the message queue in batches for as long as the process runs."""
+    while True:
+        batch = [_message_queue.get()]
+        deadline = time.monotonic() + MESSAGE_FLUSH_INTERVAL
+        while len(batch) < MESSAGE_BATCH_SIZE:
+            try:
+                batch.append(_message_queue.get(timeout=max(deadline - time.monotonic(), 0)))
+            except Empty:
+                break
+        # this is the only writer: if it dies, messages queue up forever with no error to anyone
+        try:
+            _send_batch(batch)
+        except Exception:
+            app.logger.exception("message batch of %d failed", len(batch))
+            try:
+                for _, _, _, _, sid in batch:
+                    socketio.emit('error', {'error': 'message could not be saved'}, to=sid)
+            except Exception:
+                app.logger.exception("could not report the failed batch to its senders")
+
+socketio.start_background_task(_flush_messages)
+
 # --- SocketIO events ---
+@socketio.on('connect')
+def on_connect():
+    # every socket sits in its user's personal room, so a DM to user_<id> reaches all their tabs
+    if current_user.is_authenticated:
+        join_room(f"user_{current_user.id}")
+
 @socketio.on('join')
 def on_join(data):
     room_id = data.get('room')
-    room = Room.query.get(room_id)
+    room = cached_room(room_id)
     if not room:
         emit('error', {'error': 'room not found'})
         return
+    room_id, room_name, _ = room
     # check if user is banned or muted in room
-    ban = Ban.query.filter_by(user_id=current_user.id, room_id=room.id).first()
-    if ban:
+    if current_user.banned or is_banned(current_user.id, room_id):
         emit('error', {'error': 'you are banned from this room'})
         return
-    join_room(room.room_name)
-    emit('status', {'msg': f"{current_user.nickname} has joined."}, room=room.room_name)
+    join_room(room_name)
+    _broadcast_if_subscribed('status', {'msg': f"{current_user.nickname} has joined."}, room_name)
 
 @socketio.on('leave')
 def on_leave(data):
     room_name = data.get('room_name')
     leave_room(room_name)
-    emit('status', {'msg': f"{current_user.nickname} has left."}, room=room_name)
+    _broadcast_if_subscribed('status', {'msg': f"{current_user.nickname} has left."}, room_name)
 
 @socketio.on('message')
 def on_message(data):
     # data: {room_id, content, reply_to (optional), to_user (optional for private)}
-    content = (data.get('content') or '').strip()
+    content = data.get('content')
+    if not isinstance(content, str):
+        return
+    # reject oversized payloads before bleach and the profanity scan ever see them
+    if len(content) > MAX_MESSAGE_LENGTH:
+        emit('error', {'error': 'message too long'})
+        return
+    room_id = data.get('room_id')
+    if room_id is not None:
+        # the chat page sends ids as strings
+        try:
+            room_id = int(room_id)
+        except (TypeError, ValueError):
+            emit('error', {'error': 'room not found'})
+            return
+
+    content = content.strip()
     if not content:
         return
     content = sanitize(content)
     # profanity filter
-    from utils import contains_profanity
     if contains_profanity(content):
         emit('error', {'error': 'message blocked by profanity filter'})
         return
 
-    room_id = data.get('room_id')
     reply_to = data.get('reply_to')
     to_user = data.get('to_user')  # for private messages
 
-    # check mute
-    mute = Mute.query.filter_by(user_id=current_user.id, room_id=room_id).first()
-    if mute and mute.expires_at and mute.expires_at > datetime.utcnow():
+    # check mute: site-wide first (no I/O), then the room
+    if (current_user.muted_until and current_user.muted_until > datetime.utcnow()) or is_muted(current_user.id, room_id):
         emit('error', {'error': 'you are muted'})
         return
 
-    msg = Message(
-        user_id=current_user.id,
-        room_id=room_id,
-        content=content,
-        timestamp=datetime.utcnow(),
-        reply_to=reply_to,
-        is_private=bool(to_user)
-    )
-    db.session.add(msg)
-    db.session.commit()
+    if to_user:
+        # private: emit to both users' personal rooms
+        event, rooms = 'private_message', [f"user_{to_user}", f"user_{current_user.id}"]
+    else:
+        room = cached_room(room_id)
+        if not room:
+            emit('error', {'error': 'room not found'})
+            return
+        room_id, room_name, _ = room
+        event, rooms = 'message', [room_name]
 
+    row = {
+        'user_id': current_user.id,
+        'room_id': room_id,
+        'content': content,
+        'reply_to': reply_to,
+        'is_private': bool(to_user),
+    }
     payload = {
-        'id': msg.id,
         'user': {'id': current_user.id, 'nickname': current_user.nickname, 'avatar': current_user.avatar},
         'content': content,
-        'timestamp': msg.timestamp.isoformat(),
         'reply_to': reply_to,
     }
-    if to_user:
-        # private: emit to both users' personal rooms
-        personal_room = f"user_{to_user}"
-        my_room = f"user_{current_user.id}"
-        emit('private_message', payload, room=personal_room)
-        emit('private_message', payload, room=my_room)
-    else:
-        r = Room.query.get(room_id)
-        emit('message', payload, room=r.room_name)
+    # written and broadcast by _flush_messages once the row has an id and timestamp
+    _message_queue.put((row, payload, event, rooms, request.sid))
 
 # additional events: reactions, typing, edit, delete (left as TODO)
 
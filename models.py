@@ -14,6 +14,10 @@ class User(db.Model, UserMixin):
     bio = db.Column(db.Text, nullable=True)
     is_admin = db.Column(db.Boolean, default=False)
     is_moderator = db.Column(db.Boolean, default=False)
+    # site-wide moderation lives on the row so checks read the already-loaded current_user;
+    # Ban/Mute rows remain for room-scoped cases
+    banned = db.Column(db.Boolean, default=False)
+    muted_until = db.Column(db.DateTime, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     def set_password(self, pw):
@@ -31,15 +35,28 @@ class Room(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 class Message(db.Model):
+    # room history is read newest/oldest-first per room; lets the planner range-scan in order.
+    # search sorts all messages by timestamp and stops at 100, which the second index serves.
+    __table_args__ = (
+        db.Index('ix_message_room_timestamp', 'room_id', 'timestamp'),
+        db.Index('ix_message_timestamp', 'timestamp'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     room_id = db.Column(db.Integer, db.ForeignKey('room.id'), nullable=True)
     content = db.Column(db.Text)
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    # set by the database, in UTC. It is shared by every row written in one batch (and to the second
+    # on SQLite), so anything ordering messages must break ties on id
+    timestamp = db.Column(db.DateTime, server_default=db.func.current_timestamp())
     reply_to = db.Column(db.Integer, db.ForeignKey('message.id'), nullable=True)
     is_private = db.Column(db.Boolean, default=False)
+    # never lazy-load authors one row at a time; queries that render them must eager-load
+    user = db.relationship('User', lazy='raise')
 
 class Reaction(db.Model):
+    __table_args__ = (db.Index('ix_reaction_message', 'message_id'),)
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     message_id = db.Column(db.Integer, db.ForeignKey('message.id'))
@@ -59,6 +76,9 @@ class Block(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 class Ban(db.Model):
+    # looked up by (user, room) whenever a moderation cache entry expires
+    __table_args__ = (db.Index('ix_ban_user_room', 'user_id', 'room_id'),)
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     room_id = db.Column(db.Integer, db.ForeignKey('room.id'), nullable=True) # null => global
@@ -66,6 +86,8 @@ class Ban(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 class Mute(db.Model):
+    __table_args__ = (db.Index('ix_mute_user_room', 'user_id', 'room_id'),)
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     room_id = db.Column(db.Integer, db.ForeignKey('room.id'), nullable=True)
@@ -0,0 +1,57 @@
+import os
+import sys
+from contextlib import contextmanager
+
+import pytest
+
+# configure before app.py is imported: an in-memory database, no Redis
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL', 'sqlite://')
+os.environ.pop('REDIS_URL', None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event
+
+from app import app as flask_app, cache, db
+from models import User
+
+@pytest.fixture
+def app():
+    flask_app.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+    with flask_app.app_context():
+        db.create_all()
+        yield flask_app
+        db.session.remove()
+        db.drop_all()
+    cache.clear()
+
+@pytest.fixture
+def user(app):
+    u = User(name='a', email='a@example.com', nickname='nick', phone='1', avatar='a.png')
+    u.set_password('secret1')
+    db.session.add(u)
+    db.session.commit()
+    return u
+
+@pytest.fixture
+def client(app, user):
+    """Test client logged in as `user`."""
+    c = app.test_client()
+    with c.session_transaction() as s:
+        s['_user_id'] = str(user.id)
+        s['_fresh'] = True
+    db.session.expunge_all()  # requests must load what they render, not reuse fixture objects
+    return c
+
+@contextmanager
+def count_queries():
+    """Collect every SQL statement sent to the database inside the block."""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
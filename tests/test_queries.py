@@ -0,0 +1,55 @@
+import app as app_module
+from app import _store_messages, db
+from models import Message, Room, User
+
+from conftest import count_queries
+
+def test_search_loads_authors_in_one_query(client, monkeypatch):
+    for i in range(10):
+        author = User(name=f'u{i}', email=f'u{i}@example.com', nickname=f'n{i}', phone=f'p{i}')
+        db.session.add(author)
+        db.session.flush()
+        db.session.add(Message(user_id=author.id, content=f'hello {i}'))
+    db.session.commit()
+    db.session.expunge_all()
+    # stand-in for search.html: touch every hit's author the way the page would
+    monkeypatch.setattr(app_module, 'render_template',
+                        lambda name, results, q: ','.join(m.user.nickname for m in results))
+
+    with count_queries() as statements:
+        resp = client.get('/search?q=hello')
+
+    assert resp.status_code == 200
+    assert len(resp.get_data(as_text=True).split(',')) == 10
+    # current_user, the messages, then all their authors in one SELECT ... IN
+    assert len(statements) <= 3
+
+def test_chat_room_list_is_one_query(client):
+    db.session.add_all([Room(room_name=f'room{i}') for i in range(20)])
+    db.session.commit()
+    db.session.expunge_all()
+
+    with count_queries() as statements:
+        assert client.get('/chat').status_code == 200
+    # current_user and the room list, however many rooms there are
+    assert len(statements) <= 2
+
+    with count_queries() as statements:
+        assert client.get('/chat').status_code == 200
+    # the room list now comes from the cache
+    assert len(statements) <= 1
+
+def test_message_batch_is_one_insert(app, user):
+    rows = [{'user_id': user.id, 'room_id': None, 'content': str(i), 'reply_to': None, 'is_private': False}
+            for i in range(50)]
+
+    with count_queries() as statements:
+        saved = _store_messages(rows)
+
+    assert [message_id for message_id, _ in saved] == sorted(message_id for message_id, _ in saved)
+    assert all(timestamp is not None for _, timestamp in saved)
+    inserts = [s for s in statements if s.startswith('INSERT')]
+    # PostgreSQL gets one multi-row INSERT; SQLite can't return server-generated ids in a
+    # guaranteed order from one, so SQLAlchemy sends a statement per row in the same transaction
+    assert len(inserts) == (1 if db.engine.dialect.name == 'postgresql' else len(rows))
+    assert db.session.query(Message).count() == len(rows)
@@ -1,9 +1,60 @@
+import re
+
+import orjson
+from flask.json.provider import JSONProvider
+
 # simple profanity checker - replace with a more complete list or service
 PROFANITY = {"badword1","badword2"}  # extend from file or 3rd-party API
 
+def _trie_pattern(words):
+    """Regex source matching any of words, factored into a prefix tree.
+
+    A flat "a|b|c" alternation makes the engine retry every word at each position;
+    the tree branches once per character, so cost tracks word length, not list size.
+    """
+    words = [w for w in words if w]
+    if not words:
+        return r'(?!)'  # never matches; an empty alternation would match everything
+    trie = {}
+    for w in words:
+        node = trie
+        for ch in w.lower():
+            node = node.setdefault(ch, {})
+        node[''] = None  # a word ends here
+
+    def build(node):
+        # we only ask "is there a match", so a word that ends here makes longer ones moot
+        if '' in node:
+            return ''
+        alts = [re.escape(ch) + build(child) for ch, child in sorted(node.items())]
+        return alts[0] if len(alts) == 1 else '(?:' + '|'.join(alts) + ')'
+
+    return build(trie)
+
+# compiled once at import: a single C-level pass per message instead of
+# lowercasing the text and scanning it once per word. The list is ASCII, so
+# re.ASCII lets case-insensitive matching skip full Unicode case folding.
+_PROFANITY_RE = re.compile(_trie_pattern(PROFANITY), re.IGNORECASE | re.ASCII)
+
 def contains_profanity(text):
-    t = text.lower()
-    for w in PROFANITY:
-        if w in t:
-            return True
-    return False
+    return _PROFANITY_RE.search(text) is not None
+
+class OrjsonCodec:
+    """json-module stand-in for Socket.IO packets; orjson encodes datetimes natively."""
+
+    @staticmethod
+    def dumps(obj, **kwargs):
+        # python-socketio passes separators=...; orjson output is already compact
+        return orjson.dumps(obj).decode()
+
+    loads = staticmethod(orjson.loads)
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson, used by jsonify and request.json."""
+
+    def dumps(self, obj, **kwargs):
+        # Flask passes json-module options (e.g. separators); orjson output is already compact
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)